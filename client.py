@@ -1,49 +1,221 @@
 import asyncio
-from typing import Optional, List, Dict
+import itertools
+import os
+import re
+import sys
+import threading
+from typing import Optional, List, Dict, Callable, Tuple
 from contextlib import AsyncExitStack
 
 from mcp import ClientSession, StdioServerParameters, Tool
 from mcp.client.stdio import stdio_client
 
-from anthropic import Anthropic
+import httpx
+from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient, NOT_GIVEN
 from dotenv import load_dotenv
 
 load_dotenv()  # load environment variables from .env
 
+# Batching trades latency for throughput: one request replaces up to MAX_BATCH_SIZE,
+# saving per-request overhead and rate-limit budget, but no answer is available until
+# the whole reply has been generated, and output time grows with every query added.
+# 16 keeps a full batch within the model's output limit at BATCH_TOKENS_PER_QUERY each.
+MAX_BATCH_SIZE = 16
+BATCH_TOKENS_PER_QUERY = 500
+MAX_OUTPUT_TOKENS = 8192
+BATCH_SYSTEM_PROMPT = (
+    "You will receive several questions labeled [Q<n>]. "
+    "Answer each one in its own block labeled [A<n>] with the matching number, "
+    "in the same order, and write nothing outside those blocks."
+)
+BATCH_ANSWER_RE = re.compile(r'\[A(\d+)\]\s*(.*?)(?=\[A\d+\]|$)', re.S)
+
+HELP_TEXT = "\n".join([
+    "Type your queries or use commands:",
+    "  /connect <server_id> <script_path> - Connect to a new server",
+    "  /switch <server_id> - Switch active server",
+    "  /list - List connected servers",
+    "  /disconnect <server_id> - Disconnect from a server",
+    "  /refresh - Reload tools from all servers",
+    "  /batch <file> - Answer every line of a file in batched requests",
+    "  /help - Show this help",
+    "  /quit - Exit the client",
+]) + "\n"
+BANNER = "\nMCP Client Started!\n" + HELP_TEXT
+
+# One Anthropic client (and httpx connection pool) shared by every MCPClient
+_shared_anthropic: Optional[AsyncAnthropic] = None
+
+def get_shared_anthropic() -> AsyncAnthropic:
+    """Return the process-wide Anthropic client, creating it on first use"""
+    global _shared_anthropic
+    if _shared_anthropic is None:
+        _shared_anthropic = AsyncAnthropic(
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60)
+            )
+        )
+    return _shared_anthropic
+
+async def close_shared_anthropic():
+    """Close the shared Anthropic client once no MCPClient needs it anymore"""
+    global _shared_anthropic
+    if _shared_anthropic is not None:
+        await _shared_anthropic.close()
+        _shared_anthropic = None
+
+# Bytes read from stdin past the last returned line
+_stdin_pending = b""
+
+def _read_stdin_line() -> str:
+    """Read one line straight from the stdin file descriptor
+
+    Bypasses sys.stdin's buffered reader, whose lock a blocked reader thread
+    would still hold at interpreter shutdown.
+    """
+    global _stdin_pending
+    while b"\n" not in _stdin_pending:
+        chunk = os.read(sys.stdin.fileno(), 4096)
+        if not chunk:
+            if not _stdin_pending:
+                raise EOFError
+            break
+        _stdin_pending += chunk
+    line, _, _stdin_pending = _stdin_pending.partition(b"\n")
+    return line.decode(sys.stdin.encoding or "utf-8", errors="replace")
+
+async def ainput(prompt: str) -> str:
+    """Read a line from stdin without blocking the event loop
+
+    Uses a daemon thread so a pending read never keeps the process alive on exit.
+    Raises EOFError when stdin is closed.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def set_result(value, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(value)
+
+    def read():
+        try:
+            value, error = _read_stdin_line(), None
+        except Exception as e:
+            value, error = None, e
+        try:
+            loop.call_soon_threadsafe(set_result, value, error)
+        except RuntimeError:
+            pass  # event loop already closed
+
+    sys.stdout.write(prompt)
+    sys.stdout.flush()
+    threading.Thread(target=read, daemon=True).start()
+    return await future
+
 class ServerConnection:
     """Class to manage individual server connections"""
-    def __init__(self, server_id: str, session: ClientSession, stdio, write):
+    def __init__(self, server_id: str, max_concurrency: int = 8):
         self.server_id = server_id
-        self.session = session
-        self.stdio = stdio
-        self.write = write
+        self.session: Optional[ClientSession] = None
+        self.stdio = None
+        self.write = None
         self.tools: List[Tool] = []
+        # Tools in the shape the Anthropic API expects, rebuilt only by list_tools()
+        self._anthropic_tools: List[dict] = []
+        # Limit in-flight tool calls so a large fan-out doesn't swamp the server process
+        self._sem = asyncio.Semaphore(max_concurrency)
+        # Owns this server's transport and session so they can be closed independently
+        self._stack = AsyncExitStack()
+        self._closing = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    async def open(cls, server_id: str, server_params: StdioServerParameters,
+                   max_concurrency: int = 8) -> "ServerConnection":
+        """Start the server process and return an initialized connection"""
+        conn = cls(server_id, max_concurrency)
+        ready = asyncio.get_running_loop().create_future()
+        conn._task = asyncio.create_task(conn._run(server_params, ready))
+        await ready
+        return conn
+
+    async def _run(self, server_params: StdioServerParameters, ready: asyncio.Future):
+        """Hold the transport open until close() is called
+
+        Runs in its own task because the stdio transport's cancel scopes must be
+        exited by the task that entered them, in any disconnect order.
+        """
+        try:
+            async with self._stack:
+                self.stdio, self.write = await self._stack.enter_async_context(stdio_client(server_params))
+                self.session = await self._stack.enter_async_context(ClientSession(self.stdio, self.write))
+                await self.session.initialize()
+                ready.set_result(None)
+                await self._closing.wait()
+        except Exception as e:
+            if ready.done():
+                raise
+            ready.set_exception(e)
+        except BaseException:
+            if not ready.done():
+                ready.cancel()
+            raise
 
     async def list_tools(self):
         """List available tools for this server"""
         response = await self.session.list_tools()
         self.tools = response.tools
+        self._anthropic_tools = [
+            {
+                "name": tool.name,
+                "description": f"[Server: {self.server_id}] {tool.description}",
+                "input_schema": tool.inputSchema
+            }
+            for tool in self.tools
+        ]
         return self.tools
     
     async def call_tool(self, tool_name: str, tool_args: dict):
         """Call a tool on this server"""
-        return await self.session.call_tool(tool_name, tool_args)
+        # The MCP transport encodes messages with pydantic-core, so tool_args is
+        # passed as a dict rather than pre-serialized here
+        async with self._sem:
+            return await self.session.call_tool(tool_name, tool_args)
+
+    async def close(self):
+        """Close the session and terminate the server process"""
+        self._closing.set()
+        if self._task is not None:
+            await self._task
     
 class MCPClient:
     def __init__(self):
-        # Initialize session and client objects
-        self.session: Optional[ClientSession] = None
-        self.exit_stack = AsyncExitStack()
-        self.anthropic = Anthropic()
+        # Initialize client objects; each ServerConnection owns its own session
         self.servers: Dict[str, ServerConnection] = {}
         self.current_server_id: Optional[str] = None
-
-    async def connect_to_server(self, server_id: str, server_script_path: str):
+        self._model = "claude-3-5-sonnet-20241022"
+        self._max_tokens = 1000
+        # Cached Claude tool payload, rebuilt only when servers change
+        self._tools_cache: list = []
+        self._server_tool_map: dict = {}
+
+    @property
+    def anthropic(self) -> AsyncAnthropic:
+        """The process-wide shared Anthropic client, looked up on every use so a
+        client recreated after close_shared_anthropic() is picked up"""
+        return get_shared_anthropic()
+
+    async def connect_to_server(self, server_id: str, server_script_path: str, max_concurrency: int = 8):
         """Connect to an MCP server
 
         Args:
             server_id: Unique identifier for this server connection
             server_script_path: Path to the server script (.py or .js)
+            max_concurrency: Maximum number of tool calls in flight on this server
         """
         if server_id in self.servers:
             print(f"Server with ID '{server_id}' already exists.")
@@ -61,19 +233,14 @@ class MCPClient:
             env=None
         )
 
-        stdio_transport = await self.exit_stack.enter_async_context(stdio_client(server_params))
-        self.stdio, self.write = stdio_transport
-        self.session = await self.exit_stack.enter_async_context(ClientSession(self.stdio, self.write))
-
-        await self.session.initialize()
-
-        server_conn = ServerConnection(server_id, self.session, self.stdio, self.write)
+        server_conn = await ServerConnection.open(server_id, server_params, max_concurrency)
         self.servers[server_id] = server_conn
 
         if self.current_server_id is None:
             self.current_server_id = server_id
 
         tools = await server_conn.list_tools()
+        self._recompute_tools()
         print("\nConnected to server with tools:", [tool.name for tool in tools])
 
     def switch_server(self, server_id: str) -> bool:
@@ -92,31 +259,69 @@ class MCPClient:
             print("No servers connected")
             return
         
-        print("\nConnected servers:")
+        lines = ["\nConnected servers:"]
         for server_id, server in self.servers.items():
             status = "ACTIVE" if server_id == self.current_server_id else "CONNECTED"
             tool_names = [tool.name for tool in server.tools]
-            print(f"  - {server_id} [{status}: Tools: {tool_names}]")
+            lines.append(f"  - {server_id} [{status}: Tools: {tool_names}]")
+        print("\n".join(lines))
 
-    async def disconnected_server(self, server_id:str):
+    async def disconnect_server(self, server_id: str):
         """Disconnect from a specific server"""
         if server_id not in self.servers:
             print(f"Server '{server_id}' not found")
             return False
 
-        del self.servers[server_id]
+        server = self.servers.pop(server_id)
+        try:
+            await server.close()
+        finally:
+            # The server is gone either way; stop routing tools to it
+            self._recompute_tools()
+
+            if server_id == self.current_server_id:
+                if self.servers:
+                    self.current_server_id = next(iter(self.servers.keys()))
+                else:
+                    self.current_server_id = None
 
-        if server_id == self.current_server_id:
-            if self.servers:
-                self.current_server_id = next(iter(self.servers.keys()))
-            else:
-                self.current_server_id = None
-        
         print(f"Disconnected from server: {server_id}")
         return True
 
-    async def process_query(self, query: str) -> str:
-        """Process a query using Claude and available tools"""
+    async def refresh_tools(self):
+        """Reload tools from all connected servers and rebuild the cached payload"""
+        # Fetch tools from all servers concurrently; one failing server doesn't stop the rest
+        servers = list(self.servers.items())
+        results = await asyncio.gather(
+            *(server.list_tools() for _, server in servers),
+            return_exceptions=True
+        )
+
+        for (server_id, _), result in zip(servers, results):
+            if isinstance(result, BaseException):
+                print(f"Failed to list tools for server '{server_id}', keeping its previous tools: {result}")
+
+        self._recompute_tools()
+
+    def _recompute_tools(self):
+        """Rebuild the Claude tool payload from each server's cached tools"""
+        tools = list(itertools.chain.from_iterable(
+            s._anthropic_tools for s in self.servers.values()
+        ))
+        # Mark the end of the tool list as a prompt-cache breakpoint so repeated
+        # turns reuse the processed tool schemas; copy to keep the server's list clean
+        if tools:
+            tools[-1] = {**tools[-1], "cache_control": {"type": "ephemeral"}}
+        self._tools_cache = tools
+        self._server_tool_map = {t.name: sid for sid, s in self.servers.items() for t in s.tools}
+
+    async def process_query(self, query: str, on_text: Optional[Callable[[str], None]] = None) -> str:
+        """Process a query using Claude and available tools
+
+        Args:
+            query: The user's query
+            on_text: Optional callback receiving response text as it streams in
+        """
         if not self.current_server_id:
             return " No active server. Please to at least one server first"
         
@@ -127,92 +332,153 @@ class MCPClient:
             }
         ]
 
-        all_tools = []
-        server_tool_map = {}
+        final_text, _, _ = await self._run_conversation(messages, on_text=on_text)
+        return "\n".join(final_text)
+
+    async def process_batch(self, queries: List[str]) -> List[str]:
+        """Answer several queries with one Claude request per MAX_BATCH_SIZE chunk
 
-        for server_id, server in self.servers.items():
-            tools = await server.list_tools()
-            for tool in tools:
-                tool_dict = {
-                    "name": tool.name,
-                    "description": f"[Server: {server_id}] {tool.description}",
-                    "input_schema": tool.inputSchema
+        Each request gets BATCH_TOKENS_PER_QUERY output tokens per query. If a reply
+        still hits the token limit, the last answer and any missing ones are marked
+        as truncated rather than returned as complete.
+        """
+        if not self.current_server_id:
+            return [" No active server. Please to at least one server first"] * len(queries)
+
+        answers = []
+        for start in range(0, len(queries), MAX_BATCH_SIZE):
+            chunk = queries[start:start + MAX_BATCH_SIZE]
+            messages = [
+                {
+                    "role": "user",
+                    "content": "\n".join(f"[Q{i}] {q}" for i, q in enumerate(chunk))
                 }
-                all_tools.append(tool_dict)
-                server_tool_map[tool.name] = server_id
-
-         # Initial Claude API call
-        response = self.anthropic.messages.create(
-            model="claude-3-5-sonnet-20241022",
-            max_tokens=1000,
+            ]
+
+            max_tokens = min(BATCH_TOKENS_PER_QUERY * len(chunk), MAX_OUTPUT_TOKENS)
+            _, answer_text, stop_reason = await self._run_conversation(
+                messages, system=BATCH_SYSTEM_PROMPT, max_tokens=max_tokens
+            )
+            parsed = {int(i): a.strip() for i, a in BATCH_ANSWER_RE.findall("\n".join(answer_text))}
+
+            missing = "Error: No answer returned for this query."
+            if stop_reason == 'max_tokens':
+                missing = "Error: Reply was truncated before this query was answered."
+                if parsed:
+                    last = max(parsed)
+                    parsed[last] = f"{parsed[last]} [truncated]"
+            answers.extend(parsed.get(i, missing) for i in range(len(chunk)))
+
+        return answers
+
+    def _claude(self, messages: list, system: Optional[str] = None, max_tokens: Optional[int] = None):
+        """Open a streaming Claude request with the client's model, limits and cached tools"""
+        return self.anthropic.messages.stream(
+            model=self._model,
+            max_tokens=max_tokens if max_tokens is not None else self._max_tokens,
             messages=messages,
-            tools=all_tools
+            tools=self._tools_cache,
+            system=system if system is not None else NOT_GIVEN
         )
 
-        # Process response and handle tool calls
-        final_text = []
+    async def _dispatch_tool(self, tool_use, server_tool_map: dict):
+        """Execute a single tool_use block on the server that owns the tool"""
+        server = self.servers[server_tool_map[tool_use.name]]
+        return await server.call_tool(tool_use.name, tool_use.input)
 
-        assistant_message_content = []
-        for content in response.content:
-            if content.type == 'text':
-                final_text.append(content.text)
-                assistant_message_content.append(content)
-            elif content.type == 'tool_use':
-                tool_name = content.name
-                tool_args = content.input
-                
-                # Find which server this tool belongs to
-                if tool_name in server_tool_map:
-                    server_id = server_tool_map[tool_name]
-                    server = self.servers[server_id]
-                    
-                    # Execute tool call on the appropriate server
-                    result = await server.call_tool(tool_name, tool_args)
-                    final_text.append(f"[Calling tool {tool_name} on server {server_id} with args {tool_args}]")
-
-                    assistant_message_content.append(content)
-                    messages.append({
-                        "role": "assistant",
-                        "content": assistant_message_content
-                    })
-                    messages.append({
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "tool_result",
-                                "tool_use_id": content.id,
-                                "content": result.content
-                            }
-                        ]
-                    })
+    async def _run_conversation(self, messages: list, system: Optional[str] = None,
+                                on_text: Optional[Callable[[str], None]] = None,
+                                max_tokens: Optional[int] = None) -> Tuple[List[str], List[str], Optional[str]]:
+        """Call Claude and execute requested tools until it stops asking for them
+
+        Responses are streamed: text is forwarded to on_text as it arrives, and each
+        tool call starts executing as soon as its block is complete.
 
-                    # Get next response from Claude
-                    response = self.anthropic.messages.create(
-                        model="claude-3-5-sonnet-20241022",
-                        max_tokens=1000,
-                        messages=messages,
-                        tools=all_tools
-                    )
+        Returns:
+            The full transcript including tool-call notes, only Claude's text blocks,
+            and the stop_reason of the final response.
+        """
+        server_tool_map = self._server_tool_map
+
+        final_text = []
+        answer_text = []
 
-                    final_text.append(response.content[0].text)
+        while True:
+            tasks = {}
+            try:
+                async with self._claude(messages, system, max_tokens) as stream:
+                    async for event in stream:
+                        if event.type == 'text' and on_text is not None:
+                            on_text(event.text)
+                        elif (event.type == 'content_block_stop'
+                              and event.content_block.type == 'tool_use'
+                              and event.content_block.name in server_tool_map):
+                            block = event.content_block
+                            tasks[block.id] = asyncio.create_task(self._dispatch_tool(block, server_tool_map))
+                    response = await stream.get_final_message()
+
+                tool_uses = []
+                for content in response.content:
+                    if content.type == 'text':
+                        final_text.append(content.text)
+                        answer_text.append(content.text)
+                    elif content.type == 'tool_use':
+                        tool_uses.append(content)
+
+                if response.stop_reason != 'tool_use' or not tool_uses:
+                    break
+
+                # Tool calls were started during streaming; wait for all of them
+                known = [t for t in tool_uses if t.id in tasks]
+                results = dict(zip(
+                    (t.id for t in known),
+                    await asyncio.gather(*(tasks[t.id] for t in known))
+                ))
+            finally:
+                for task in tasks.values():
+                    task.cancel()
+
+            # Unknown tools get an error result in the same turn so Claude can correct itself
+            tool_results = []
+            for t in tool_uses:
+                if t.id in results:
+                    note = f"[Calling tool {t.name} on server {server_tool_map[t.name]} with args {t.input}]"
+                    tool_results.append({
+                        "type": "tool_result",
+                        "tool_use_id": t.id,
+                        "content": results[t.id].content
+                    })
                 else:
-                    final_text.append(f"Error: Tool {tool_name} not found on any connected server.")
+                    note = f"Error: Tool {t.name} not found on any connected server."
+                    tool_results.append({
+                        "type": "tool_result",
+                        "tool_use_id": t.id,
+                        "is_error": True,
+                        "content": f"Unknown tool {t.name}"
+                    })
+                final_text.append(note)
+                if on_text is not None:
+                    on_text(f"\n{note}\n")
+
+            messages.append({
+                "role": "assistant",
+                "content": response.content
+            })
+            messages.append({
+                "role": "user",
+                "content": tool_results
+            })
 
-        return "\n".join(final_text)
+        return final_text, answer_text, response.stop_reason
     
     async def chat_loop(self):
         """Run an interactive chat loop"""
-        print("\nMCP Client Started!")
-        print("Type your queries or use commands:")
-        print("  /connect <server_id> <script_path> - Connect to a new server")
-        print("  /switch <server_id> - Switch active server")
-        print("  /list - List connected servers")
-        print("  /disconnect <server_id> - Disconnect from a server")
-        print("  /quit - Exit the client")
+        sys.stdout.write(BANNER)
 
         while True:
             try:
-                user_input = input("\nQuery or command: ").strip()
+                # Read stdin in a daemon thread so the event loop keeps running
+                user_input = (await ainput("\nQuery or command: ")).strip()
 
                 if user_input.lower() == '/quit':
                     break
@@ -232,19 +498,45 @@ class MCPClient:
                         self.list_servers()
                     elif command == '/disconnect' and len(parts) >= 2:
                         await self.disconnect_server(parts[1])
+                    elif command == '/batch' and len(parts) >= 2:
+                        with open(parts[1]) as f:
+                            queries = [line.strip() for line in f if line.strip()]
+                        answers = await self.process_batch(queries)
+                        print("".join(f"\n> {query}\n{answer}" for query, answer in zip(queries, answers)))
+                    elif command == '/help':
+                        sys.stdout.write(HELP_TEXT)
+                    elif command == '/refresh':
+                        await self.refresh_tools()
+                        print(f"Refreshed tools: {list(self._server_tool_map.keys())}")
                     else:
                         print("Invalid command format. Type /help for available commands.")
                 else:
-                    # Process regular query
-                    response = await self.process_query(user_input)
-                    print("\n" + response)
+                    # Process regular query, printing text as it streams in
+                    streamed = []
+
+                    def write_text(text: str):
+                        streamed.append(text)
+                        sys.stdout.write(text)
+                        sys.stdout.flush()
 
+                    print()
+                    response = await self.process_query(user_input, on_text=write_text)
+                    print("" if streamed else response)
+
+            except EOFError:
+                # stdin closed (Ctrl-D or end of piped input)
+                break
             except Exception as e:
                 print(f"\nError: {str(e)}")
 
     async def cleanup(self):
         """Clean up resources"""
-        await self.exit_stack.aclose()
+        for server_id, server in list(self.servers.items()):
+            try:
+                await server.close()
+            except Exception as e:
+                print(f"Error closing server '{server_id}': {str(e)}")
+        self.servers.clear()
 
 
     
\ No newline at end of file
@@ -1,6 +1,13 @@
-from client import MCPClient
-
 import asyncio
+import sys
+
+from client import MCPClient, close_shared_anthropic
+
+try:
+    # libuv-based event loop, used when installed (not available on Windows)
+    import uvloop
+except ImportError:
+    uvloop = None
 
 async def main():
     if len(sys.argv) < 3:
@@ -24,7 +31,10 @@ async def main():
         await client.chat_loop()
     finally:
         await client.cleanup()
+        await close_shared_anthropic()
 
 if __name__ == "__main__":
-    import sys
-    asyncio.run(main())
\ No newline at end of file
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
\ No newline at end of file